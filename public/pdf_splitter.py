@@ -1,164 +1,341 @@
 # pdf_splitter.py (Modified for Pyodide/Browser)
 
-from io import BytesIO  # Use in-memory bytes buffer
+from io import BytesIO, StringIO  # Use in-memory buffers
 from pypdf import PdfReader, PdfWriter
-from itertools import chain
-import json, re, unicodedata as ud
+from pypdf.generic import Destination
+from itertools import chain, islice
+from collections import deque
+import json, os, sys, threading, traceback, unicodedata as ud, zipfile
+
+try:
+    import pymupdf as fitz  # PyMuPDF: C engine, much faster than pypdf for slicing
+except ImportError:
+    try:
+        import fitz  # Older PyMuPDF releases only ship the `fitz` name
+    except ImportError:  # No Pyodide wheel, so the browser always uses pypdf
+        fitz = None
+
+# Set to False to force the pure-Python pypdf path even when PyMuPDF is installed
+USE_FITZ = fitz is not None
+
+try:
+    import orjson  # Rust-backed, much faster than the stdlib encoder
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+except ImportError:  # Not installed by default under Pyodide
+
+    def _dumps(obj) -> str:
+        # orjson always writes raw UTF-8; match it so output doesn't depend on the install
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+
+
+# Maps ASCII word bytes to themselves and everything else to a space
+_SLUG_TABLE = bytes(
+    c if c < 128 and (chr(c).isalnum() or c == ord("_")) else ord(" ")
+    for c in range(256)
+)
 
 
 # --- Helper functions (mostly unchanged) ---
 def slugify(s: str) -> str:
     if not isinstance(s, str):
         raise TypeError(f"slugify expected str, got {type(s)}: {s}")
-    s = ud.normalize("NFKD", s).encode("ascii", "ignore").decode()
-    return re.sub(r"[^\w]+", "_", s).strip("_").lower() or "unknown"
+    if s.isascii():  # Plain ASCII titles need no normalization
+        b = s.encode("ascii")
+    else:
+        b = ud.normalize("NFKD", s).encode("ascii", "ignore")
+    # split() collapses the runs of non-word bytes that join() turns into "_"
+    b = b"_".join(b.translate(_SLUG_TABLE).split()).strip(b"_")
+    return b.lower().decode() or "unknown"
 
 
 def resolve_title(obj) -> str:
     try:
-        return obj.title() if callable(obj.title) else obj.title
+        title = obj.title  # Fetch once; on pypdf objects this is a dictionary lookup
+        return title() if callable(title) else title
     except Exception:
         return "unknown"
 
 
-def outline_to_ranges(reader: PdfReader):
-    outlines = list(reader.outline)
-    tops = [o for o in outlines if not isinstance(o, list)]
-    # Handle cases where outline destinations might be invalid or None
-    pages = []
-    valid_tops = []
-    for o in tops:
-        try:
-            page_num = reader.get_destination_page_number(o)
-            if page_num is not None:
-                pages.append(page_num)
-                valid_tops.append(o)
+# Walk the outline once and return (depth, title, page, chapter) for every
+# resolvable item. Destination lookups are the expensive part, so all consumers
+# share this list. `chapter` is the 1-based position in the top-level outline
+# (nested lists and unresolvable items take up a position too), None when nested.
+# Problems are appended to `warnings` rather than printed one at a time.
+def _flatten_outline(reader: PdfReader, outline, warnings: list):
+    flat = []
+
+    def walk(outline, depth=0):
+        for position, item in enumerate(outline, 1):
+            if isinstance(item, list):
+                walk(item, depth + 1)
+                continue
+            # Outline items are Destinations, whose title is a plain property
+            if isinstance(item, Destination):
+                title = item.title
             else:
-                print(
-                    f"Warning: Could not get page number for outline item: {resolve_title(o)}"
+                title = resolve_title(item)
+            try:
+                page_num = reader.get_destination_page_number(item)
+            except Exception as e:
+                warnings.append(f"Warning: Error processing outline item {title}: {e}")
+                continue
+            if page_num is None:
+                warnings.append(
+                    f"Warning: Could not get page number for outline item: {title}"
                 )
-        except Exception as e:
-            print(f"Warning: Error processing outline item {resolve_title(o)}: {e}")
+                continue
+            flat.append((depth, title, page_num, position if depth == 0 else None))
+
+    walk(outline)
+    return flat
+
+
+# PyMuPDF equivalent of _flatten_outline, built from doc.get_toc()
+def _flatten_toc(doc, warnings: list):
+    flat = []
+    position = 0
+    prev_level = 1
+    for level, title, page in doc.get_toc(simple=True):
+        # Mirror pypdf's outline positions: each top-level item counts, and so
+        # does each run of children, which pypdf returns as one nested list
+        if level == 1 or prev_level == 1:
+            position += 1
+        prev_level = level
+        if page < 1:  # PyMuPDF reports unresolvable destinations as -1
+            warnings.append(
+                f"Warning: Could not get page number for outline item: {title}"
+            )
+            continue
+        flat.append((level - 1, title, page - 1, position if level == 1 else None))
+    return flat
 
-    if not pages:  # No valid top-level outlines found
+
+def outline_to_ranges(flat, n_pages: int):
+    tops = [(title, page) for depth, title, page, _ in flat if depth == 0]
+    if not tops:  # No valid top-level outlines found
         return []
 
-    end_pages = chain(pages[1:], [len(reader.pages)])
-    return [
-        (f"{i+1:02d}_{slugify(resolve_title(t))}", s, e)
-        for i, (t, s, e) in enumerate(zip(valid_tops, pages, end_pages))
-        # Ensure start page is less than end page
-        if s < e
-    ]
+    # Outlines aren't guaranteed to be in page order; sort so each chapter ends
+    # where the next one starts instead of yielding inverted, dropped ranges
+    tops.sort(key=lambda top: top[1])
+    pages = [p for _, p in tops]
+    end_pages = chain(pages[1:], [n_pages])
+    # Ensure start page is less than end page; after sorting only entries sharing
+    # a start page fail this. Filter before numbering so chapter numbers have no gaps
+    kept = [(t, s, e) for (t, s), e in zip(tops, end_pages) if s < e]
+    return [(f"{i+1:02d}_{slugify(t)}", s, e) for i, (t, s, e) in enumerate(kept)]
 
 
 # --- Modified functions for browser ---
 
 
+# Expected output size of a slice: its share of the source plus 10% headroom
+def _estimate_slice_size(source_size: int, n_pages: int, start: int, end: int) -> int:
+    return int(source_size * (end - start) / max(1, n_pages) * 1.1)
+
+
+# One output buffer per thread, reused across slices so its allocation stays warm
+_local = threading.local()
+
+
+def _slice_buffer(size_hint: int) -> BytesIO:
+    buffer = getattr(_local, "buffer", None)
+    # seek(0, 2) reports the buffer's size; it is never truncated, so it only grows
+    if buffer is None or buffer.seek(0, 2) < size_hint:
+        buffer = _local.buffer = BytesIO(bytes(size_hint))
+    buffer.seek(0)
+    return buffer
+
+
 # Instead of writing to disk, return bytes
-def create_slice_data(reader: PdfReader, triple):
+# n_pages is len(reader.pages), computed once by the caller
+def create_slice_data(
+    reader: PdfReader, triple, n_pages: int, warnings: list, source_size: int = 0
+):
     name, start, end = triple
     writer = PdfWriter()
+    if end > n_pages:
+        warnings.append(
+            f"Warning: Page index {n_pages} out of bounds (total pages: {n_pages}) for slice {name}"
+        )
+        end = n_pages  # Clamp the slice to the pages that exist
+    added = 0  # Tracked here; len(writer.pages) walks the writer's page tree
     # Add error handling for page indexing
     try:
         for i in range(start, end):
-            if i < len(reader.pages):
-                writer.add_page(reader.pages[i])
-            else:
-                print(
-                    f"Warning: Page index {i} out of bounds (total pages: {len(reader.pages)}) for slice {name}"
-                )
-                break  # Stop adding pages for this slice if out of bounds
+            # Annotations are left out: link annotations point into the rest of the
+            # source, so copying them drags in foreign pages and fails on densely
+            # cross-linked PDFs ("Detected loop with self reference"). This also
+            # drops non-link annotations (comments, highlights, form widgets)
+            writer.add_page(reader.pages[i], excluded_keys=("/Annots",))
+            added += 1
     except Exception as e:
-        print(f"Error creating slice '{name}' (pages {start}-{end}): {e}")
+        warnings.append(f"Error creating slice '{name}' (pages {start}-{end}): {e}")
         return name, None  # Return None for data if error occurs
 
-    if len(writer.pages) == 0:
-        print(f"Warning: Slice '{name}' resulted in an empty PDF.")
+    if added == 0:
+        warnings.append(f"Warning: Slice '{name}' resulted in an empty PDF.")
         return name, None  # No pages added, return None
 
-    # Write to an in-memory buffer
-    buffer = BytesIO()
+    # Write to the shared in-memory buffer, sized so writer.write() doesn't keep regrowing it
+    buffer = _slice_buffer(_estimate_slice_size(source_size, n_pages, start, end))
     writer.write(buffer)
-    buffer.seek(0)
-    return name, buffer.getvalue()  # Return filename slug and bytes
+    # Copy out only what this slice wrote; bytes past tell() belong to earlier slices
+    with buffer.getbuffer() as view:
+        data = bytes(view[: buffer.tell()])
+    return name, data  # Return filename slug and bytes
 
 
-# Instead of writing to disk, return JSON string
-def create_toc_json(reader: PdfReader):
-    toc = []
-    for i, d in enumerate(reader.outline):
-        # Check if it's a potential valid outline item before processing
-        if hasattr(d, "title"):
-            try:
-                page_num = reader.get_destination_page_number(d)
-                if page_num is not None:
-                    toc.append(
-                        {
-                            "chapter": i + 1,  # Or adjust logic based on nesting
-                            "title": resolve_title(d),
-                            "page": page_num + 1,  # User-friendly 1-based index
-                        }
-                    )
-                else:
-                    print(
-                        f"Warning: Could not get page number for TOC item: {resolve_title(d)}"
-                    )
-            except Exception as e:
-                print(f"Warning: Error processing TOC item {resolve_title(d)}: {e}")
+# PyMuPDF equivalent of create_slice_data
+def create_slice_data_fitz(doc, triple, warnings: list):
+    name, start, end = triple
+    total = doc.page_count
+    if end > total:
+        warnings.append(
+            f"Warning: Page index {total} out of bounds (total pages: {total}) for slice {name}"
+        )
+        end = total  # Clamp the slice to the pages that exist
+    if start >= end:
+        warnings.append(f"Warning: Slice '{name}' resulted in an empty PDF.")
+        return name, None
 
-    return json.dumps(toc, indent=2)
+    try:
+        with fitz.open() as out:
+            out.insert_pdf(doc, from_page=start, to_page=end - 1)
+            return name, out.tobytes()
+    except Exception as e:
+        warnings.append(f"Error creating slice '{name}' (pages {start}-{end}): {e}")
+        return name, None
 
 
-# Instead of writing to disk, return text string and also collect print output
-def create_toc_text(reader: PdfReader):
-    toc_lines = ["📚 Table of Contents:"]
-    console_output = []  # Collect print statements
+# Below this many pages, starting worker processes and having each one parse the
+# source costs more than slicing serially
+_POOL_MIN_PAGES = 300
 
-    def collect_outline(outline, reader, indent=0):
-        for item in outline:
-            if isinstance(item, list):
-                collect_outline(item, reader, indent + 2)
+# Chapters in flight per worker on the pool path
+_POOL_WINDOW = 2
+
+# Per-process (reader, n_pages, source_size), set up once by _init_slice_worker
+_worker_source = None
+
+
+# Process-pool initializer: each worker parses the source PDF once, up front
+def _init_slice_worker(pdf_bytes):
+    global _worker_source
+    reader = PdfReader(BytesIO(pdf_bytes))
+    _worker_source = (reader, len(reader.pages), len(pdf_bytes))
+
+
+# Process-pool entry point: slices from the worker's reader and sends its
+# warnings back alongside the slice
+def _slice_worker(triple):
+    reader, n_pages, source_size = _worker_source
+    warnings = []
+    name, data = create_slice_data(reader, triple, n_pages, warnings, source_size)
+    return name, data, warnings
+
+
+# `source` is a PdfReader, or a fitz.Document when use_fitz is set
+def create_slices(source, pdf_bytes, ranges, n_pages, warnings: list, use_fitz=False):
+    # Slices are yielded one at a time so callers can drop each one once handled
+    max_workers = min(os.cpu_count() or 1, 4, len(ranges))
+    # Pyodide has no subprocesses, so slice serially in the browser. PyMuPDF
+    # slices in C, and small documents don't amortize the pool's start-up cost
+    if (
+        sys.platform == "emscripten"
+        or use_fitz
+        or max_workers < 2
+        or n_pages < _POOL_MIN_PAGES
+    ):
+        for triple in ranges:
+            if use_fitz:
+                yield create_slice_data_fitz(source, triple, warnings)
             else:
-                title = resolve_title(item)
-                try:
-                    page_num = reader.get_destination_page_number(item)
-                    if page_num is not None:
-                        line = (
-                            " " * indent + f"- {title} (p{page_num+1})"  # 1-based index
-                        )
-                        toc_lines.append(line)
-                        console_output.append(line)  # Add to console output too
-                    else:
-                        print(
-                            f"Warning: Could not get page number for outline item: {title}"
-                        )
-                except Exception as e:
-                    print(f"Warning: Error processing outline item {title}: {e}")
+                yield create_slice_data(
+                    source, triple, n_pages, warnings, len(pdf_bytes)
+                )
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # The source is sent once per worker rather than once per chapter; bytes()
+    # also turns memoryviews and bytearrays into something picklable
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_slice_worker,
+        initargs=(bytes(pdf_bytes),),
+    ) as ex:
+        # map() would submit every chapter at once and let finished ones pile up;
+        # keep a small window in flight so memory follows the consumer instead
+        triples = iter(ranges)
+        pending = deque(
+            ex.submit(_slice_worker, triple)
+            for triple in islice(triples, _POOL_WINDOW * max_workers)
+        )
+        while pending:
+            name, data, worker_warnings = pending.popleft().result()
+            warnings.extend(worker_warnings)
+            yield name, data
+            # Refill only once the caller is done with this chapter, so no more
+            # than _POOL_WINDOW * max_workers chapters are ever alive at once
+            for triple in islice(triples, 1):
+                pending.append(ex.submit(_slice_worker, triple))
+
+
+# Instead of writing to disk, build the text TOC, its console log and the JSON TOC
+# in a single pass over the flattened outline
+def _build_tocs(flat):
+    console_buf = StringIO()  # Collect print statements
+    toc_json_list = []
+
+    for depth, title, page, chapter in flat:
+        if console_buf.tell():
+            console_buf.write("\n")
+        console_buf.write(" " * (depth * 2))
+        console_buf.write(f"- {title} (p{page+1})")  # 1-based index
+        if depth == 0:
+            toc_json_list.append(
+                {
+                    "chapter": chapter,  # Or adjust logic based on nesting
+                    "title": title,
+                    "page": page + 1,  # User-friendly 1-based index
+                }
+            )
 
-    try:
-        collect_outline(reader.outline, reader)
-    except Exception as e:
-        print(f"Error generating text TOC: {e}")
-        toc_lines.append(f"\nError generating TOC: {e}")
+    # The text TOC is the console log under a heading
+    console_output = console_buf.getvalue()
+    toc_text = "📚 Table of Contents:"
+    if console_output:
+        toc_text += "\n" + console_output
 
     # Also print TOC to console (will appear in browser dev tools)
-    for l in toc_lines:
-        print(l)  # Pyodide redirects this to console
+    print(toc_text)  # Pyodide redirects this to console
 
-    return "\n".join(toc_lines), "\n".join(
-        console_output
-    )  # Return text and console log
+    return toc_text, console_output, _dumps(toc_json_list)
 
 
 # Main function to be called from JavaScript
-def split_pdf_data(pdf_bytes, original_filename="input.pdf"):
+def split_pdf_data(
+    pdf_bytes, original_filename="input.pdf", on_chapter=None, as_zip=False
+):
     """
     Splits a PDF given as bytes based on its outline.
 
     Args:
         pdf_bytes (bytes): The content of the PDF file.
         original_filename (str): The original name of the file (for context).
+        on_chapter (callable, optional): Called as on_chapter(filename, pdf_bytes)
+            as soon as each chapter is ready. Chapters handed to the callback are
+            not kept: the serial (and Pyodide) path holds one chapter at a time,
+            the process-pool path at most two per worker, counting the one
+            being passed to on_chapter.
+        as_zip (bool): Bundle all chapters into one uncompressed ZIP archive
+            returned as 'zip', so the caller receives a single bytes object.
+            Ignored when on_chapter is given: chapters go to the callback
+            and 'zip' stays None.
 
     Returns:
         dict: A dictionary containing:
@@ -166,27 +343,53 @@ def split_pdf_data(pdf_bytes, original_filename="input.pdf"):
             'message': A status message or error details.
             'toc_text': The generated plain text TOC.
             'toc_json': The generated JSON TOC string.
-            'chapters': A list of tuples, each being (filename, pdf_bytes).
+            'blob': All chapter PDFs packed back to back into one bytearray.
+            'index': A list of (filename, offset, length) tuples locating each
+                chapter inside 'blob'. Both are empty when on_chapter or as_zip
+                is given.
+            'zip': The chapters as ZIP archive bytes when as_zip is set, else None.
             'console_log': Captured print output from TOC generation.
+            'warnings': Every warning raised while reading the outline and
+                slicing, one per line.
     """
     results = {
         "status": "error",
         "message": "Processing started...",
         "toc_text": "",
         "toc_json": "",
-        "chapters": [],
+        "blob": bytearray(),
+        "index": [],
+        "zip": None,
         "console_log": "",
+        "warnings": "",
     }
+    warnings = []  # Collected here and emitted once at the end
+    use_fitz = USE_FITZ
+    source = None
     try:
-        reader = PdfReader(BytesIO(pdf_bytes))
+        if use_fitz:
+            source = fitz.open(stream=pdf_bytes, filetype="pdf")
+            n_pages = source.page_count
+        else:
+            source = PdfReader(BytesIO(pdf_bytes))
+            # Both are recomputed by pypdf on every access, so read them once
+            n_pages = len(source.pages)
+            outline = source.outline
         results["message"] = f"Processing '{original_filename}'..."
 
+        # Resolve the outline once and share it across all consumers
+        if use_fitz:
+            flat = _flatten_toc(source, warnings)
+        else:
+            flat = _flatten_outline(source, outline, warnings)
+
         # Generate TOCs first
-        results["toc_text"], results["console_log"] = create_toc_text(reader)
-        results["toc_json"] = create_toc_json(reader)
+        results["toc_text"], results["console_log"], results["toc_json"] = _build_tocs(
+            flat
+        )
 
         # Get ranges and create chapter slices
-        ranges = outline_to_ranges(reader)
+        ranges = outline_to_ranges(flat, n_pages)
         if not ranges:
             results[
                 "message"
@@ -198,30 +401,53 @@ def split_pdf_data(pdf_bytes, original_filename="input.pdf"):
             )
             return results
 
-        chapters_data = []
-        for triple in ranges:
-            name, data = create_slice_data(reader, triple)
+        # One contiguous buffer crosses to JS as a single Uint8Array instead of N bytes
+        blob = results["blob"]
+        index = results["index"]
+        chapter_count = 0
+        if as_zip and on_chapter is None:
+            # PDF streams are already compressed, so store rather than deflate
+            zip_buffer = BytesIO()
+            zip_file = zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED)
+        else:
+            zip_file = None
+        for name, data in create_slices(
+            source, pdf_bytes, ranges, n_pages, warnings, use_fitz
+        ):
             if data:  # Only add if slice creation was successful and yielded data
                 # Append .pdf extension here
-                chapters_data.append((f"{name}.pdf", data))
+                if on_chapter is not None:
+                    on_chapter(f"{name}.pdf", data)
+                elif zip_file is not None:
+                    zip_file.writestr(f"{name}.pdf", data)
+                else:
+                    index.append((f"{name}.pdf", len(blob), len(data)))
+                    blob += data
+                chapter_count += 1
             else:
-                print(f"Skipping empty or errored slice: {name}")
+                warnings.append(f"Skipping empty or errored slice: {name}")
                 results[
                     "message"
                 ] += f"\nWarning: Slice '{name}' could not be generated or was empty."
 
-        results["chapters"] = chapters_data
+        if zip_file is not None:
+            zip_file.close()
+            results["zip"] = zip_buffer.getvalue()
         results["status"] = "success"
         results["message"] = (
-            f"Successfully processed '{original_filename}'. Found {len(chapters_data)} chapters."
+            f"Successfully processed '{original_filename}'. Found {chapter_count} chapters."
         )
 
     except Exception as e:
-        import traceback
-
         results["message"] = f"Error processing PDF: {e}\n{traceback.format_exc()}"
-        print(f"Error: {e}")  # Log error to console too
-        traceback.print_exc()
+        print(results["message"])  # Log error to console too
+    finally:
+        if use_fitz and source is not None:
+            source.close()
+        _local.buffer = None  # Don't keep the slice buffer alive between files
+        if warnings:
+            results["warnings"] = "\n".join(warnings)
+            print(results["warnings"])
 
     return results
 
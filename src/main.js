@@ -180,6 +180,9 @@ document.addEventListener('DOMContentLoaded', () => {
       if (results.console_log) {
         outputElement.textContent += '\n\n--- Console Log (from TOC generation) ---\n' + results.console_log;
       }
+      if (results.warnings) {
+        outputElement.textContent += '\n\n--- Warnings ---\n' + results.warnings;
+      }
 
       downloadsElement.innerHTML = ''; // Clear processing message
 
@@ -204,28 +207,16 @@ document.addEventListener('DOMContentLoaded', () => {
           createDownloadLink(results.toc_json, 'chapters.json', 'application/json', downloadsElement);
         }
 
-        // Store chapter PDFs
-        if (results.chapters && results.chapters.length > 0) {
-          for (const chapter of results.chapters) {
-            const filename = chapter[0];
-            const pdfData = chapter[1];
-            let pdfBytes = null;
-
-            if (typeof pdfData?.toJs === 'function') {
-              const jsBytes = pdfData.toJs();
-              if (jsBytes instanceof Uint8Array) pdfBytes = jsBytes;
-              else try {
-                pdfBytes = new Uint8Array(jsBytes);
-              } catch (e) {
-                console.warn('Failed Uint8Array conversion for', filename, e);
-              }
-            } else if (pdfData instanceof Uint8Array) {
-              pdfBytes = pdfData;
-            } else if (pdfData instanceof ArrayBuffer) {
-              pdfBytes = new Uint8Array(pdfData);
-            } else {
-              console.error(`Unsupported data type for chapter ${filename}:`, typeof pdfData);
-            }
+        // Store chapter PDFs: one shared buffer, sliced by its (filename, offset, length) index
+        if (results.index && results.index.length > 0) {
+          const blobBytes = toUint8Array(results.blob);
+          if (!blobBytes) {
+            console.error('Unsupported data type for chapter buffer:', typeof results.blob);
+          }
+
+          for (const [filename, offset, length] of results.index) {
+            // subarray() is a view into the shared buffer, not a copy
+            const pdfBytes = blobBytes ? blobBytes.subarray(offset, offset + length) : null;
 
             if (pdfBytes) {
               generatedFiles.push({
@@ -318,7 +309,24 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   });
 
-  // --- 6. Helper Function to Create Download Links ---
+  // --- 6. Helper Function to Convert Python Bytes to a Uint8Array ---
+  function toUint8Array(data) {
+    if (typeof data?.toJs === 'function') {
+      const jsBytes = data.toJs();
+      if (jsBytes instanceof Uint8Array) return jsBytes;
+      try {
+        return new Uint8Array(jsBytes);
+      } catch (e) {
+        console.warn('Failed Uint8Array conversion', e);
+        return null;
+      }
+    }
+    if (data instanceof Uint8Array) return data;
+    if (data instanceof ArrayBuffer) return new Uint8Array(data);
+    return null;
+  }
+
+  // --- 7. Helper Function to Create Download Links ---
   function createDownloadLink(data, filename, mimeType, containerElement) {
     const blob = new Blob([data], { type: mimeType });
     const url = URL.createObjectURL(blob);